@@ -1,17 +1,27 @@
-import requests
+import asyncio
+import gzip
+import httpx
+import orjson
 import sqlite3
 import json
+import logging
+import threading
 import time
-import xml.etree.ElementTree as ET
-import pytz
-from datetime import datetime
+from xml.sax.saxutils import XMLGenerator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 import os
+import shutil
+import sys
 from atproto import Client, models
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+log = logging.getLogger("wahoo")
+
 # Mapping of URLs to device names
 URLS = {
     "elemnt": "https://bolt.wahoofitness.com/boltapp/version.json",
@@ -22,21 +32,57 @@ URLS = {
     "roam2": "https://bolt.wahoofitness.com/boltapp/version.json-roam2",
     "ace": "https://bolt.wahoofitness.com/boltapp/version.json-ace"
 }
+_URL_ITEMS = tuple(URLS.items())
+
+# (release type, version key, url key) for each release channel in version.json
+RELEASE_TYPES = (
+    ("std", "std-version", "std-url"),
+    ("beta", "beta-version", "beta-url"),
+    ("alpha", "alpha-version", "alpha-url"),
+)
 
 # SQLite database file
 DB_FILE = "versions.db"
 RSS_FILE = "versions.rss"
+# ETag/Last-Modified validators per URL, kept outside the DB so unchanged polls never open it
+HTTP_CACHE_FILE = "http_cache.json"
+
+LOCAL_TZ = ZoneInfo('America/Denver')  # Replace with your local timezone
 
 PUSHOVER_USER_KEY = os.getenv('PUSHOVER_USER_KEY')
 PUSHOVER_API_TOKEN = os.getenv('PUSHOVER_API_TOKEN')
 BLUESKY_USERNAME = os.getenv('BLUESKY_USERNAME')
 BLUESKY_APP_PASSWORD = os.getenv('BLUESKY_APP_PASSWORD')
+BLUESKY_SESSION_FILE = ".bsky_session"
 
 client = None
+bluesky_lock = threading.Lock()
 
-def init_db():
-    """Initialize the SQLite database and create the necessary table."""
+# Notifications are sent in the background so they don't hold up the DB work
+NOTIFY_POOL = ThreadPoolExecutor(max_workers=4)
+
+# Returned by fetch_version_data when the server reports the data is unchanged
+NOT_MODIFIED = object()
+
+# Shared HTTP client so repeated requests to the same host reuse connections.
+# The pool matches NOTIFY_POOL so each notification thread can hold a connection.
+HTTP_CLIENT = httpx.Client(
+    timeout=10.0,
+    follow_redirects=True,
+    transport=httpx.HTTPTransport(http2=True, retries=3, limits=httpx.Limits(max_connections=4)),
+)
+
+def _connect():
+    """Open a connection to the SQLite database with WAL-friendly pragmas."""
     conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def init_db(conn):
+    """Initialize the SQLite database and create the necessary table."""
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS versions (
@@ -49,23 +95,79 @@ def init_db():
             UNIQUE(device, version, release_type)
         )
     ''')
+    # Covering index so the RSS query is an index-only scan with no sort step
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_versions_first_seen_cover "
+        "ON versions(first_seen DESC, device, version, url, release_type)"
+    )
     conn.commit()
-    conn.close()
 
-def fetch_version_data(url):
-    """Fetch JSON data from a given URL."""
+def _remove_temp_file(path):
+    """Remove a temporary file if it still exists."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def load_http_cache():
+    """Return the stored (etag, last_modified) validators keyed by URL."""
+    try:
+        with open(HTTP_CACHE_FILE, "rb") as f:
+            return {url: tuple(validators) for url, validators in orjson.loads(f.read()).items()}
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+def save_http_cache(http_cache):
+    """Store the validators keyed by URL, replacing the file atomically."""
+    tmp_file = HTTP_CACHE_FILE + ".tmp"
     try:
-        response = requests.get(url, timeout=10)
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(http_cache))
+        os.replace(tmp_file, HTTP_CACHE_FILE)
+    finally:
+        _remove_temp_file(tmp_file)
+
+async def fetch_version_data(http_client, url, validators=None):
+    """Fetch JSON data from a given URL.
+
+    Returns a (data, validators) tuple. data is NOT_MODIFIED if the server
+    answered a conditional request with 304, or None on error.
+    """
+    etag, last_modified = validators or (None, None)
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    try:
+        response = await http_client.get(url, headers=headers)
+        if response.status_code == 304:
+            return NOT_MODIFIED, None
         response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        print(f"Error fetching {url}: {e}")
-        return None
+        data = orjson.loads(response.content)
+    except (httpx.HTTPError, ValueError) as e:
+        # ValueError covers bodies that aren't valid JSON (orjson.JSONDecodeError)
+        log.error("Error fetching %s: %s", url, e)
+        return None, None
+
+    if not isinstance(data, dict):
+        log.error("Error fetching %s: expected a JSON object", url)
+        return None, None
+    return data, (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+async def fetch_all_version_data(http_cache):
+    """Fetch JSON data for every device concurrently, in URLS order."""
+    limits = httpx.Limits(max_keepalive_connections=10)
+    async with httpx.AsyncClient(http2=True, timeout=10.0, limits=limits, follow_redirects=True) as http_client:
+        return await asyncio.gather(
+            *(fetch_version_data(http_client, url, http_cache.get(url)) for _, url in _URL_ITEMS)
+        )
 
 def send_pushover_alert(device, version, release_type):
     """Send a Pushover alert for a new BoltApp version."""
     if not PUSHOVER_USER_KEY or not PUSHOVER_API_TOKEN:
-        print("Pushover user key or API token not set.")
+        log.warning("Pushover user key or API token not set.")
         return
 
     message = f"New BoltApp update for {device}: {version} ({release_type})"
@@ -76,30 +178,71 @@ def send_pushover_alert(device, version, release_type):
     }
 
     try:
-        response = requests.post("https://api.pushover.net/1/messages.json", data=data)
+        response = HTTP_CLIENT.post("https://api.pushover.net/1/messages.json", data=data, timeout=5)
         response.raise_for_status()
-        print("Pushover alert sent.")
-    except requests.RequestException as e:
-        print(f"Error sending Pushover alert: {e}")
+        log.info("Pushover alert sent.")
+    except httpx.HTTPError as e:
+        log.error("Error sending Pushover alert: %s", e)
 
-def login_to_bluesky():
+def load_bluesky_session():
+    """Return the saved BlueSky session string, if any."""
+    try:
+        with open(BLUESKY_SESSION_FILE) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def save_bluesky_session(session_string):
+    """Save the BlueSky session string so later runs can skip the password login."""
+    try:
+        # The session holds bearer tokens, so keep it private to the owner
+        fd = os.open(BLUESKY_SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(session_string)
+    except OSError as e:
+        log.error("Error saving BlueSky session: %s", e)
+
+def new_bluesky_client():
+    """Return a BlueSky client that saves its session whenever it changes."""
+    new_client = Client()
+    # Refresh tokens are single-use, so every refresh has to be persisted too
+    new_client.on_session_change(lambda event, session: save_bluesky_session(session.export()))
+    return new_client
+
+def login_to_bluesky(use_saved_session=True):
     """Login to BlueSky and return the client."""
     global client
     if not BLUESKY_USERNAME or not BLUESKY_APP_PASSWORD:
-        print("BlueSky username or app password not set.")
+        log.warning("BlueSky username or app password not set.")
         return None
 
+    session_string = load_bluesky_session() if use_saved_session else None
+    if session_string:
+        try:
+            client = new_bluesky_client()
+            client.login(session_string=session_string)
+            log.info("Resumed BlueSky session.")
+            return client
+        except Exception as e:
+            log.warning("Saved BlueSky session rejected, logging in again: %s", e)
+
     try:
-        client = Client()
+        client = new_bluesky_client()
         client.login(BLUESKY_USERNAME, BLUESKY_APP_PASSWORD)
-        print("Logged into BlueSky.")
+        log.info("Logged into BlueSky.")
         return client
     except Exception as e:
-        print(f"Error logging into BlueSky: {e}")
+        log.error("Error logging into BlueSky: %s", e)
         return None
 
 def post_to_bluesky(device, version, release_type):
     """Post a new BoltApp version to BlueSky"""
+    # Posts run on the notification pool; serialize them so only one thread logs in
+    with bluesky_lock:
+        _post_to_bluesky(device, version, release_type)
+
+def _post_to_bluesky(device, version, release_type):
     global client
     if client is None:
         client = login_to_bluesky()
@@ -111,94 +254,165 @@ def post_to_bluesky(device, version, release_type):
     try:
         
         client.send_post(text=message)
-        print("Posted to BlueSky.")
+        log.info("Posted to BlueSky.")
     except Exception as e:
-        print(f"Error posting to BlueSky: {e}")
-        # Attempt to re-login and post again
-        client = login_to_bluesky()
+        log.error("Error posting to BlueSky: %s", e)
+        # Attempt a fresh password login in case the saved session went stale
+        client = login_to_bluesky(use_saved_session=False)
         if client:
             try:
                 client.send_post(text=message)
-                print("Posted to BlueSky after re-login.")
+                log.info("Posted to BlueSky after re-login.")
             except Exception as e:
-                print(f"Error posting to BlueSky after re-login: {e}")
+                log.error("Error posting to BlueSky after re-login: %s", e)
 
-def store_version(device, version, apk_url, release_type):
-    """Store the version in the database if it's new."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def store_versions(candidates, conn):
+    """Store new versions in a single statement and return the ones that were new."""
+    if not candidates:
+        return []
+    # One multi-row INSERT; sqlite3's executemany() can't hand back RETURNING rows
+    placeholders = ", ".join(["(?, ?, ?, ?)"] * len(candidates))
+    params = [value for candidate in candidates for value in candidate]
+    with conn:
+        return conn.execute(
+            f"INSERT OR IGNORE INTO versions (device, version, url, release_type) VALUES {placeholders} RETURNING device, version, release_type",
+            params
+        ).fetchall()
+
+def _run_notification(notify, device, version, release_type):
+    """Run a notifier on the pool, logging anything it didn't handle itself."""
     try:
-        cursor.execute(
-            "INSERT INTO versions (device, version, url, release_type) VALUES (?, ?, ?, ?)",
-            (device, version, apk_url, release_type)
-        )
-        conn.commit()
-        print(f"New version recorded: {device} - {version} ({release_type})")
-        
-        if PUSHOVER_USER_KEY and PUSHOVER_API_TOKEN:
-            send_pushover_alert(device, version, release_type)
-            
-        if BLUESKY_USERNAME and BLUESKY_APP_PASSWORD:    
-            post_to_bluesky(device, version, release_type)
-
-    except sqlite3.IntegrityError:
-        print(f"Version {version} ({release_type}) for {device} already recorded.")
-    finally:
-        conn.close()
+        notify(device, version, release_type)
+    except Exception:
+        log.exception("Unexpected error in %s", notify.__name__)
+
+def notify_new_version(device, version, release_type):
+    """Announce a newly recorded version on the configured channels."""
+    log.info("New version recorded: %s - %s (%s)", device, version, release_type)
+
+    if PUSHOVER_USER_KEY and PUSHOVER_API_TOKEN:
+        NOTIFY_POOL.submit(_run_notification, send_pushover_alert, device, version, release_type)
 
-def generate_rss():
+    if BLUESKY_USERNAME and BLUESKY_APP_PASSWORD:
+        NOTIFY_POOL.submit(_run_notification, post_to_bluesky, device, version, release_type)
+
+def _write_text_element(xml, name, text):
+    """Write a simple <name>text</name> element."""
+    xml.startElement(name, {})
+    xml.characters(text)
+    xml.endElement(name)
+
+def generate_rss(conn):
     """Generate an RSS feed with the versions found."""
-    conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     cursor.execute("SELECT device, version, url, release_type, first_seen FROM versions ORDER BY first_seen DESC LIMIT 100")
-    entries = cursor.fetchall()
-    conn.close()
-
-    rss = ET.Element("rss", version="2.0")
-    channel = ET.SubElement(rss, "channel")
-    ET.SubElement(channel, "title").text = "Wahoo Versions RSS Feed"
-    ET.SubElement(channel, "link").text = "https://example.com/versions.rss"
-    ET.SubElement(channel, "description").text = "Latest firmware versions for Wahoo devices."
-
-    local_tz = pytz.timezone('America/Denver')  # Replace with your local timezone
-
-    for device, version, url, release_type, first_seen in entries:
-        item = ET.SubElement(channel, "item")
-        ET.SubElement(item, "title").text = f"{device} - {version} ({release_type})"
-        ET.SubElement(item, "link").text = url
-        ET.SubElement(item, "description").text = f"Version {version} ({release_type}) for {device}"
-        
-        # Convert timestamp to local timezone
-        dt = datetime.strptime(first_seen, "%Y-%m-%d %H:%M:%S")
-        dt = pytz.utc.localize(dt).astimezone(local_tz)
-        ET.SubElement(item, "pubDate").text = dt.strftime("%a, %d %b %Y %H:%M:%S %z")
 
-    tree = ET.ElementTree(rss)
-    tree.write(RSS_FILE, encoding="utf-8", xml_declaration=True)
-    print("RSS feed updated.")
+    # Stream the feed to a temporary file and swap it in so readers never see a partial file
+    tmp_file = RSS_FILE + ".tmp"
+    gz_tmp_file = RSS_FILE + ".gz.tmp"
+    try:
+        with open(tmp_file, "wb") as out:
+            xml = XMLGenerator(out, "utf-8")
+            xml.startDocument()
+            xml.startElement("rss", {"version": "2.0"})
+            xml.startElement("channel", {})
+            _write_text_element(xml, "title", "Wahoo Versions RSS Feed")
+            _write_text_element(xml, "link", "https://example.com/versions.rss")
+            _write_text_element(xml, "description", "Latest firmware versions for Wahoo devices.")
+
+            for device, version, url, release_type, first_seen in cursor:
+                xml.startElement("item", {})
+                _write_text_element(xml, "title", f"{device} - {version} ({release_type})")
+                _write_text_element(xml, "link", url)
+                _write_text_element(xml, "description", f"Version {version} ({release_type}) for {device}")
+
+                # Convert timestamp to local timezone
+                dt = datetime.fromisoformat(first_seen).replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ)
+                _write_text_element(xml, "pubDate", dt.strftime("%a, %d %b %Y %H:%M:%S %z"))
+                xml.endElement("item")
+
+            xml.endElement("channel")
+            xml.endElement("rss")
+            xml.endDocument()
+
+        # Precompressed copy for web servers that can serve .gz assets directly.
+        # The gzip header names the published file, not the temp file.
+        with open(tmp_file, "rb") as src, open(gz_tmp_file, "wb") as gz_out, \
+                gzip.GzipFile(filename=os.path.basename(RSS_FILE), mode="wb", fileobj=gz_out) as gz:
+            shutil.copyfileobj(src, gz)
+
+        os.replace(tmp_file, RSS_FILE)
+        os.replace(gz_tmp_file, RSS_FILE + ".gz")
+    finally:
+        # Only left behind if writing failed part way through
+        _remove_temp_file(tmp_file)
+        _remove_temp_file(gz_tmp_file)
+    log.info("RSS feed updated.")
 
 def main():
     """Main polling function."""
-    init_db()
-    new_version_recorded = False
-    for device, url in URLS.items():
-        data = fetch_version_data(url)
-
-        if data:
-            for release_type in ["std", "beta", "alpha"]:
-                version_key = f"{release_type}-version"
-                url_key = f"{release_type}-url"
-                if version_key in data and url_key in data:
-                    try:
-                        store_version(device, data[version_key], data[url_key], release_type)
-                        new_version_recorded = True
-                    except sqlite3.IntegrityError:
+    try:
+        # Without a DB the validators are meaningless, so fetch everything in full
+        http_cache = load_http_cache() if os.path.exists(DB_FILE) else {}
+        responses = asyncio.run(fetch_all_version_data(http_cache))
+
+        changed = []
+        for (device, url), (data, validators) in zip(_URL_ITEMS, responses):
+            if data is NOT_MODIFIED:
+                log.debug("No changes for %s.", device)
+            elif data:
+                changed.append((device, url, data, validators))
+            else:
+                log.warning("Invalid data from %s", url)
+
+        if not changed:
+            log.info("No upstream changes.")
+            return
+
+        conn = _connect()
+        try:
+            init_db(conn)
+            # Versions already in the DB, so duplicates are skipped without an INSERT
+            seen = set(conn.execute("SELECT device, version, release_type FROM versions"))
+            candidates = []
+            for device, url, data, validators in changed:
+                if validators and any(validators):
+                    http_cache[url] = validators
+                for release_type, version_key, url_key in RELEASE_TYPES:
+                    version = data.get(version_key)
+                    apk_url = data.get(url_key)
+                    if version is None or apk_url is None:
+                        continue
+                    key = (device, str(version), release_type)
+                    if key in seen:
+                        log.debug("Version %s (%s) for %s already recorded.", version, release_type, device)
                         continue
-        else:
-            print(f"Invalid data from {url}")
+                    seen.add(key)
+                    candidates.append((device, version, apk_url, release_type))
+
+            changes_before = conn.total_changes
+            new_versions = store_versions(candidates, conn)
+
+            for device, version, release_type in new_versions:
+                notify_new_version(device, version, release_type)
 
-    if new_version_recorded:
-        generate_rss()
+            if conn.total_changes > changes_before:
+                generate_rss(conn)
+
+            # Only remember validators once the versions they cover are stored
+            save_http_cache(http_cache)
+
+            # Keep planner statistics current as the table grows
+            conn.execute("PRAGMA optimize")
+        finally:
+            conn.close()
+    finally:
+        # Let queued alerts finish before the shared HTTP client goes away
+        NOTIFY_POOL.shutdown(wait=True)
+        HTTP_CLIENT.close()
 
 if __name__ == "__main__":
+    # Library loggers (httpx logs every request at INFO) stay at the root's WARNING level
+    logging.basicConfig(stream=sys.stdout, format="%(asctime)s %(message)s")
+    log.setLevel(logging.INFO)
     main()
\ No newline at end of file